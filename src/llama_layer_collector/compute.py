@@ -1,5 +1,7 @@
 import torch
 from llama_layer_collector.helpers import update_causal_mask
+from llama_layer_collector.kernels import fused_rmsnorm_matmul, HAS_TRITON
+from transformers.cache_utils import Cache
 from transformers.models.llama.modeling_llama import LlamaDecoderLayer, LlamaConfig, LlamaRotaryEmbedding, LlamaRMSNorm
 
 class LLmComputationState:
@@ -8,41 +10,67 @@ class LLmComputationState:
     position_ids: torch.Tensor
     cache_position: torch.Tensor
     causal_mask: torch.Tensor
+    past_key_values: Cache
 
+@torch.no_grad()
 def compute_embedding(
         input_embedder: torch.nn.Embedding,
         input_ids: torch.Tensor,
-        config: LlamaConfig
+        config: LlamaConfig,
+        past_key_values: Cache = None
     ) -> LLmComputationState:
+    # With a cache, only tokens past the cached prefix are embedded; each layer
+    # then attends to the cached keys/values instead of recomputing the prefix.
+    past_length = past_key_values.get_seq_length() if past_key_values is not None else 0
+    if past_length > 0:
+        input_ids = input_ids[:, past_length:]
     embedded_input = input_embedder(input_ids.to(input_embedder.weight.device))
     state = LLmComputationState()
     state.state = embedded_input
-    state.cache_position = torch.arange(0, end=embedded_input.size(1), device='cpu')
-    state.causal_mask = update_causal_mask(config, embedded_input.detach().to('cpu'), state.cache_position)
+    state.past_key_values = past_key_values
+    state.cache_position = torch.arange(past_length, end=past_length + embedded_input.size(1), device='cpu')
+    state.causal_mask = update_causal_mask(config, embedded_input.detach().to('cpu'), state.cache_position, past_length)
     state.position_ids = state.cache_position.unsqueeze(0)
     state.position_embeddings = LlamaRotaryEmbedding(config=config)(embedded_input.detach(), state.position_ids)
     return state
 
+@torch.no_grad()
 def compute_layer(
         lyr: LlamaDecoderLayer,
-        state: LLmComputationState 
+        state: LLmComputationState
     ) -> torch.Tensor:
     return lyr(
         state.state,
         attention_mask=state.causal_mask,
         position_ids=state.position_ids,
-        past_key_value=None,
+        past_key_value=state.past_key_values,
         output_attentions=False,
-        use_cache=False,
+        use_cache=state.past_key_values is not None,
         cache_position=state.cache_position,
         position_embeddings=state.position_embeddings
     )[0]
 
+@torch.no_grad()
 def compute_head(
         head: torch.nn.Linear,
         state: torch.Tensor,
         topk: int = 1
     ) -> torch.Tensor:
     state = head(state[:, -1, :])
-    probs = torch.softmax(state, dim=-1)
-    return torch.topk(probs, topk).indices
+    # softmax is monotonic, so top-k over the raw logits picks the same tokens.
+    return torch.topk(state, topk).indices
+
+@torch.no_grad()
+def compute_head_fused(
+        head: torch.nn.Linear,
+        norm: LlamaRMSNorm,
+        state: torch.Tensor,
+        topk: int = 1
+    ) -> torch.Tensor:
+    # Norm and head projection in one kernel; the normalised activation never
+    # round-trips through HBM. Falls back to the eager path off-GPU.
+    last = state[:, -1, :]
+    if not HAS_TRITON or not last.is_cuda:
+        return compute_head(head, norm(state), topk)
+    logits = fused_rmsnorm_matmul(last, norm.weight, head.weight, norm.variance_epsilon)
+    return torch.topk(logits, topk).indices
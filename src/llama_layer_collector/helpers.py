@@ -1,36 +1,318 @@
 import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List
 
 import torch
+import numpy as np
 from safetensors import safe_open
+from transformers.modeling_attn_mask_utils import AttentionMaskConverter
 from transformers.models.llama.modeling_llama import LlamaConfig, LlamaModel
 
+def _advise_willneed(path: str):
+    # WILLNEED populates the shared page cache, so prefetch started here still
+    # benefits the mapping safe_open creates later. Per-fd advice such as
+    # SEQUENTIAL would die with this throwaway fd and is deliberately not issued.
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+class ShardReader:
+    model_dir: str
+    max_open_files: int
+
+    def __init__(self, model_dir: str, max_open_files: int = 8):
+        self.model_dir = model_dir
+        self.max_open_files = max_open_files
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._copy_stream = None
+
+    def _open(self, file: str):
+        with self._lock:
+            if file in self._handles:
+                self._handles.move_to_end(file)
+                return self._handles[file]
+            if len(self._handles) >= self.max_open_files:
+                self._handles.popitem(last=False)
+            full_path = os.path.join(self.model_dir, file)
+            _advise_willneed(full_path)
+            shard = safe_open(full_path, framework='pt', device='cpu')
+            self._handles[file] = shard
+            return shard
+
+    def keys(self, file: str) -> List[str]:
+        return list(self._open(file).keys())
+
+    def _copy_to_device(self, buf: torch.Tensor, device: str) -> torch.Tensor:
+        # Copies run on a dedicated stream so they can overlap work queued on the
+        # default stream; the default stream then waits before the tensor is used.
+        if not torch.cuda.is_available():
+            return buf.to(device)
+        with self._lock:
+            if self._copy_stream is None:
+                self._copy_stream = torch.cuda.Stream(device=device)
+        with torch.cuda.stream(self._copy_stream):
+            out = buf.to(device, non_blocking=True)
+        torch.cuda.current_stream(device).wait_stream(self._copy_stream)
+        return out
+
+    def get_tensor_raw(self, file: str, layer_name: str) -> torch.Tensor:
+        # Native on-disk dtype, on CPU; no conversion pass over the mmap'd bytes.
+        return self._open(file).get_tensor(layer_name)
+
+    def get_tensor(self, file: str, layer_name: str, device: str, dtype: torch.dtype) -> torch.Tensor:
+        return self.get_tensors(file, [layer_name], device, dtype)[layer_name]
+
+    def get_tensors(
+            self,
+            file: str,
+            layer_names: List[str],
+            device: str,
+            dtype: torch.dtype
+        ) -> Dict[str, torch.Tensor]:
+        shard = self._open(file)
+        tensors = { name: shard.get_tensor(name) for name in layer_names }
+        if not str(device).startswith('cuda'):
+            return { name: t.to(dtype) for name, t in tensors.items() }
+
+        # Batch all tensors from this file into one pinned host buffer so the
+        # transfer is a single H2D copy instead of one allocation per tensor.
+        out = { }
+        by_dtype: Dict[torch.dtype, List[str]] = { }
+        for name, t in tensors.items():
+            by_dtype.setdefault(t.dtype, []).append(name)
+        for src_dtype, names in by_dtype.items():
+            total = sum(tensors[n].numel() for n in names)
+            buf = torch.empty(total, dtype=src_dtype, pin_memory=torch.cuda.is_available())
+            offset = 0
+            for name in names:
+                t = tensors[name]
+                buf[offset:offset + t.numel()].copy_(t.reshape(-1))
+                offset += t.numel()
+            buf = self._copy_to_device(buf, device)
+            offset = 0
+            for name in names:
+                t = tensors[name]
+                out[name] = buf[offset:offset + t.numel()].view(t.shape).to(dtype)
+                offset += t.numel()
+        return out
+
 def load_shard_tensor(
-        layer_file_cache: dict, 
+        layer_file_cache: dict,
         model_dir: str,
-        layer_name: str, 
+        layer_name: str,
         device: str,
-        dtype: torch.dtype
+        dtype: torch.dtype,
+        reader: ShardReader = None
+    ) -> torch.Tensor:
+    if layer_name not in layer_file_cache:
+        raise ValueError(f'Could not find layer file for layer {layer_name}')
+    if reader is None:
+        reader = ShardReader(model_dir)
+    return reader.get_tensor(layer_file_cache[layer_name], layer_name, device, dtype)
+
+def load_shard_tensor_raw(
+        layer_file_cache: dict,
+        model_dir: str,
+        layer_name: str,
+        reader: ShardReader = None
+    ) -> torch.Tensor:
+    if layer_name not in layer_file_cache:
+        raise ValueError(f'Could not find layer file for layer {layer_name}')
+    if reader is None:
+        reader = ShardReader(model_dir)
+    return reader.get_tensor_raw(layer_file_cache[layer_name], layer_name)
+
+_SIZE_LUT: Dict[tuple, np.ndarray] = { }
+
+def get_layer_sizes(dtype: torch.dtype, config: LlamaConfig) -> np.ndarray:
+    hidden = config.hidden_size
+    head_dim = getattr(config, 'head_dim', None) or hidden // config.num_attention_heads
+    key = (dtype, config.num_hidden_layers, hidden, config.num_attention_heads,
+           config.num_key_value_heads, head_dim, config.intermediate_size)
+    if key not in _SIZE_LUT:
+        attention = hidden * config.num_attention_heads * head_dim \
+            + 2 * hidden * config.num_key_value_heads * head_dim \
+            + config.num_attention_heads * head_dim * hidden
+        mlp = 3 * hidden * config.intermediate_size
+        norms = 2 * hidden
+        per_layer = (attention + mlp + norms) * torch.empty(0, dtype=dtype).element_size()
+        _SIZE_LUT[key] = np.full(config.num_hidden_layers, per_layer, dtype=np.int64)
+    return _SIZE_LUT[key]
+
+def get_size_of_layer(
+        layer_idx: int,
+        dtype: torch.dtype,
+        config: LlamaConfig
+    ) -> int:
+    if layer_idx < 0 or layer_idx >= config.num_hidden_layers:
+        raise ValueError(f'Layer index {layer_idx} out of range for {config.num_hidden_layers} layers')
+    return int(get_layer_sizes(dtype, config)[layer_idx])
+
+class FstReader:
+    model_dir: str
+    device: str
+    max_open_files: int
+
+    def __init__(self, model_dir: str, device: str, max_open_files: int = 2):
+        self.model_dir = model_dir
+        self.device = device
+        self.max_open_files = max_open_files
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _open(self, file: str):
+        # fastsafetensors copies the whole file to the device, so the buffer is
+        # memoised per file and every tensor from it is served from one copy.
+        with self._lock:
+            if file in self._handles:
+                self._handles.move_to_end(file)
+                return self._handles[file][1]
+            try:
+                from fastsafetensors import SafeTensorsFileLoader, SingleGroup
+            except ImportError as e:
+                raise ImportError('use_fastsafetensors=True requires the fastsafetensors package') from e
+            if len(self._handles) >= self.max_open_files:
+                _, (loader, _buffer) = self._handles.popitem(last=False)
+                loader.close()
+            loader = SafeTensorsFileLoader(SingleGroup(), device=self.device, nogds=False)
+            loader.add_filenames({0: [os.path.join(self.model_dir, file)]})
+            buffer = loader.copy_files_to_device()
+            self._handles[file] = (loader, buffer)
+            return buffer
+
+    def keys(self, file: str) -> List[str]:
+        # Header-only parse; avoids paying a device copy just to list names.
+        shard = safe_open(os.path.join(self.model_dir, file), framework='pt', device='cpu')
+        return list(shard.keys())
+
+    def get_tensor(self, file: str, layer_name: str, device: str, dtype: torch.dtype) -> torch.Tensor:
+        tensor = self._open(file).get_tensor(layer_name)
+        # Clone so the tensor survives the device buffer; the dtype cast runs on-GPU.
+        return tensor.to(dtype) if tensor.dtype != dtype else tensor.clone()
+
+    def get_tensors(
+            self,
+            file: str,
+            layer_names: List[str],
+            device: str,
+            dtype: torch.dtype
+        ) -> Dict[str, torch.Tensor]:
+        return { name: self.get_tensor(file, name, device, dtype) for name in layer_names }
+
+    def close(self):
+        with self._lock:
+            for loader, _buffer in self._handles.values():
+                loader.close()
+            self._handles.clear()
+
+def load_shard_tensor_fst(
+        layer_file_cache: dict,
+        model_dir: str,
+        layer_name: str,
+        device: str,
+        dtype: torch.dtype,
+        reader: FstReader = None
     ) -> torch.Tensor:
     if layer_name not in layer_file_cache:
         raise ValueError(f'Could not find layer file for layer {layer_name}')
     file = layer_file_cache[layer_name]
-    shard: dict = safe_open(os.path.join(model_dir, file), framework='pt', device=device)
-    return shard.get_tensor(layer_name).to(dtype)
+    if reader is not None:
+        return reader.get_tensor(file, layer_name, device, dtype)
+    reader = FstReader(model_dir, device)
+    try:
+        return reader.get_tensor(file, layer_name, device, dtype)
+    finally:
+        reader.close()
+
+_IGNORE_CACHE: 'OrderedDict[tuple, bool]' = OrderedDict()
+_IGNORE_CACHE_SIZE = 64
+
+def _ignore_mask_sdpa(config: LlamaConfig, input_tensor: torch.Tensor, past_key_values_length: int = 0) -> bool:
+    # sdpa attention applies causality internally via is_causal=True when there
+    # are no past tokens; single-token decode attends to everything, so neither
+    # case needs a mask for non-sliding models.
+    sliding_window = getattr(config, 'sliding_window', None)
+    if sliding_window is None:
+        return past_key_values_length == 0 or input_tensor.shape[1] == 1
+    key = (config._attn_implementation, input_tensor.shape[1], past_key_values_length, sliding_window, input_tensor.dtype)
+    if key in _IGNORE_CACHE:
+        _IGNORE_CACHE.move_to_end(key)
+        return _IGNORE_CACHE[key]
+    if len(_IGNORE_CACHE) >= _IGNORE_CACHE_SIZE:
+        _IGNORE_CACHE.popitem(last=False)
+    _IGNORE_CACHE[key] = AttentionMaskConverter._ignore_causal_mask_sdpa(
+        None,
+        inputs_embeds=input_tensor,
+        past_key_values_length=past_key_values_length,
+        sliding_window=sliding_window,
+        is_training=False,
+    )
+    return _IGNORE_CACHE[key]
+
+_MASK_CACHE: 'OrderedDict[tuple, torch.Tensor]' = OrderedDict()
+_MASK_CACHE_SIZE = 64
+
+def _build_causal_mask(
+        config: LlamaConfig,
+        batch_size: int,
+        seq_len: int,
+        dtype: torch.dtype,
+        device_str: str,
+        past_key_values_length: int = 0
+    ) -> torch.Tensor:
+    # The mask only depends on the config through its sliding window, so that
+    # value enters the key directly (configs themselves are unhashable).
+    key = (getattr(config, 'sliding_window', None), batch_size, seq_len, dtype, device_str, past_key_values_length)
+    if key in _MASK_CACHE:
+        _MASK_CACHE.move_to_end(key)
+        return _MASK_CACHE[key]
+    device = torch.device(device_str)
+    target_length = past_key_values_length + seq_len
+    if getattr(config, 'sliding_window', None) is not None:
+        # Only the sliding-window branch needs the full transformers builder.
+        mask = LlamaModel._prepare_4d_causal_attention_mask_with_cache_position(
+            None,
+            sequence_length=seq_len,
+            target_length=target_length,
+            dtype=dtype,
+            device=device,
+            cache_position=torch.arange(past_key_values_length, end=target_length, device=device),
+            batch_size=batch_size,
+            config=config,
+            past_key_values=None,
+        )
+    else:
+        # Query i sits at absolute position past + i, so key j is masked when
+        # j > past + i; that is exactly triu with offset past + 1.
+        mask = torch.full((seq_len, target_length), torch.finfo(dtype).min, dtype=dtype, device=device)
+        mask.triu_(past_key_values_length + 1)
+        mask = mask[None, None, :, :].expand(batch_size, 1, seq_len, target_length)
+    if len(_MASK_CACHE) >= _MASK_CACHE_SIZE:
+        _MASK_CACHE.popitem(last=False)
+    _MASK_CACHE[key] = mask
+    return mask
 
 def update_causal_mask(
         config: LlamaConfig,
         input_tensor: torch.Tensor,
-        cache_position: torch.Tensor
+        cache_position: torch.Tensor,
+        past_key_values_length: int = 0
     ) -> torch.Tensor:
     # In case the provided `attention` mask is 2D, we generate a causal mask here (4D).
-    return LlamaModel._prepare_4d_causal_attention_mask_with_cache_position(
-        None,
-        sequence_length=input_tensor.shape[1],
-        target_length=input_tensor.shape[1],
-        dtype=input_tensor.dtype,
-        device=input_tensor.device,
-        cache_position=cache_position,
-        batch_size=input_tensor.shape[0],
-        config=config,
-        past_key_values=None,
-    )
\ No newline at end of file
+    # The mask is a pure function of these keys, so it is memoised across decode steps.
+    if config._attn_implementation == 'sdpa' and _ignore_mask_sdpa(config, input_tensor, past_key_values_length):
+        return None
+    return _build_causal_mask(
+        config,
+        input_tensor.shape[0],
+        input_tensor.shape[1],
+        input_tensor.dtype,
+        str(input_tensor.device),
+        past_key_values_length,
+    )
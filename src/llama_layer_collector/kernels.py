@@ -0,0 +1,72 @@
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+    HAS_TRITON = True
+except ImportError:
+    HAS_TRITON = False
+
+if HAS_TRITON:
+    @triton.jit
+    def _fused_rmsnorm_matmul_kernel(
+            x_ptr, w_norm_ptr, w_head_ptr, out_ptr,
+            H, V, eps,
+            stride_xb, stride_wv, stride_ob,
+            BLOCK_V: tl.constexpr, BLOCK_H: tl.constexpr
+        ):
+        pid_v = tl.program_id(0)
+        pid_b = tl.program_id(1)
+        x_row = x_ptr + pid_b * stride_xb
+
+        # First pass: rms of the input row, accumulated in fp32.
+        sumsq = 0.0
+        for h in range(0, H, BLOCK_H):
+            offs = h + tl.arange(0, BLOCK_H)
+            xm = tl.load(x_row + offs, mask=offs < H, other=0.0).to(tl.float32)
+            sumsq += tl.sum(xm * xm)
+        rstd = 1.0 / tl.sqrt(sumsq / H + eps)
+
+        # Second pass: normalise in registers and accumulate this program's
+        # BLOCK_V rows of the head GEMV without writing the normed row to HBM.
+        v_offs = pid_v * BLOCK_V + tl.arange(0, BLOCK_V)
+        acc = tl.zeros([BLOCK_V], dtype=tl.float32)
+        for h in range(0, H, BLOCK_H):
+            offs = h + tl.arange(0, BLOCK_H)
+            h_mask = offs < H
+            xm = tl.load(x_row + offs, mask=h_mask, other=0.0).to(tl.float32)
+            wn = tl.load(w_norm_ptr + offs, mask=h_mask, other=0.0).to(tl.float32)
+            normed = xm * rstd * wn
+            w_tile = tl.load(
+                w_head_ptr + v_offs[:, None] * stride_wv + offs[None, :],
+                mask=(v_offs[:, None] < V) & h_mask[None, :],
+                other=0.0,
+            ).to(tl.float32)
+            acc += tl.sum(w_tile * normed[None, :], axis=1)
+        tl.store(out_ptr + pid_b * stride_ob + v_offs, acc, mask=v_offs < V)
+
+def fused_rmsnorm_matmul(
+        x: torch.Tensor,
+        weight_norm: torch.Tensor,
+        w_head: torch.Tensor,
+        eps: float
+    ) -> torch.Tensor:
+    if not HAS_TRITON:
+        raise ImportError('fused_rmsnorm_matmul requires the triton package')
+    if not x.is_cuda:
+        raise ValueError('fused_rmsnorm_matmul requires cuda tensors')
+    batch_size, hidden = x.shape
+    vocab = w_head.shape[0]
+    x = x.contiguous()
+    w_head = w_head.contiguous()
+    out = torch.empty(batch_size, vocab, dtype=torch.float32, device=x.device)
+    block_v = 64
+    block_h = 128
+    grid = (triton.cdiv(vocab, block_v), batch_size)
+    _fused_rmsnorm_matmul_kernel[grid](
+        x, weight_norm, w_head, out,
+        hidden, vocab, eps,
+        x.stride(0), w_head.stride(0), out.stride(0),
+        BLOCK_V=block_v, BLOCK_H=block_h,
+    )
+    return out
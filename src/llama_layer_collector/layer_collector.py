@@ -3,11 +3,12 @@ import json
 from typing import List, Dict
 
 import torch
+import numpy as np
 from transformers.models.llama.modeling_llama import LlamaRMSNorm, LlamaDecoderLayer, LlamaConfig
 
-from llama_layer_collector.load_layer import load_layers
+from llama_layer_collector.load_layer import load_layers, LayerRing
 from llama_layer_collector.cache import build_cache_data
-from llama_layer_collector.helpers import load_shard_tensor
+from llama_layer_collector.helpers import get_layer_sizes, ShardReader, FstReader
 
 class LlamaLayerCollector:
     layer_prefix: str
@@ -25,7 +26,14 @@ class LlamaLayerCollector:
     num_shards: int
     dtype: torch.dtype
     device: str
+    use_fastsafetensors: bool
+    compile: bool
+    reader: ShardReader
     layer_files: Dict[str, str]
+    layer_size_cache: List[int]
+    layer_size_bytes: np.ndarray
+    shard_files: List[str]
+    layer_file_idx: np.ndarray
 
     def __init__(
             self, 
@@ -37,7 +45,9 @@ class LlamaLayerCollector:
             norm_layer_name: str = 'model.norm.weight',
             lm_head_name: str = 'lm_head.weight',
             dtype: torch.dtype = torch.float16,
-            device: str = 'cpu'
+            device: str = 'cpu',
+            use_fastsafetensors: bool = False,
+            compile: bool = False
         ):
         config_file_path = os.path.join(model_dir, 'config.json')
         if not os.path.exists(config_file_path):
@@ -59,11 +69,19 @@ class LlamaLayerCollector:
 
         self.dtype = dtype
         self.device = device
+        self.use_fastsafetensors = use_fastsafetensors
+        self.compile = compile
+        self.reader = ShardReader(model_dir)
+        self._fst_reader = None
+        self.layer_size_bytes = get_layer_sizes(dtype, self.config)
+        self.layer_size_cache = self.layer_size_bytes.tolist()
+        self._prefix = np.cumsum(self.layer_size_bytes)
         self.layer_files = { }
         if self.cache_file is None or not os.path.exists(self.cache_file):
             self._build_cache()
         else:
             self._read_cache()
+        self._build_layer_index()
 
     def _read_cache(self):
         if not os.path.exists(self.cache_file):
@@ -77,8 +95,26 @@ class LlamaLayerCollector:
             with open(self.cache_file, 'w', encoding='utf-8') as f:
                 json.dump(self.layer_files, f, indent=4)
 
+    def _build_layer_index(self):
+        # SoA layout: layer names map to integer rows once, and per-row data
+        # lives in parallel arrays instead of being re-hashed per lookup.
+        self.shard_files = sorted(set(self.layer_files.values()))
+        file_index = { f: i for i, f in enumerate(self.shard_files) }
+        self._layer_index = { name: i for i, name in enumerate(self.layer_files.keys()) }
+        self.layer_file_idx = np.array([file_index[f] for f in self.layer_files.values()], dtype=np.int32)
+
+    def _reader_for(self, device: str):
+        if self.use_fastsafetensors and str(device).startswith('cuda'):
+            if self._fst_reader is None:
+                self._fst_reader = FstReader(self.model_dir, device)
+            return self._fst_reader
+        return self.reader
+
     def _load_shard_tensor(self, layer_name: str, device: str) -> torch.Tensor:
-        return load_shard_tensor(self.layer_files, self.model_dir, layer_name, device, self.dtype)
+        if layer_name not in self._layer_index:
+            raise ValueError(f'Could not find layer file for layer {layer_name}')
+        file = self.shard_files[int(self.layer_file_idx[self._layer_index[layer_name]])]
+        return self._reader_for(device).get_tensor(file, layer_name, device, self.dtype)
 
     def load_input_embedding(self, device: str = None) -> torch.nn.Embedding:
         device = self.device if device is None else device
@@ -99,10 +135,28 @@ class LlamaLayerCollector:
         else:
             weight = self._load_shard_tensor(self.lm_head_name, device)
 
-        head = torch.nn.Linear(weight.size()[1], weight.size()[0], device=device, dtype=self.dtype)
+        # Llama checkpoints have no lm_head bias; a bias here would stay randomly
+        # initialised and make the eager and fused head paths disagree.
+        head = torch.nn.Linear(weight.size()[1], weight.size()[0], bias=False, device=device, dtype=self.dtype)
         head.weight = torch.nn.Parameter(weight)
         return head
 
-    def load_layer_set(self, start_layer: int, end_layer: int, device: str = None) -> List[LlamaDecoderLayer]:
+    def layers_to_load_by_memory(self, start_layer: int, max_memory: int) -> int:
+        # Returns the last layer index such that layers [start_layer, end] fit in max_memory bytes.
+        if start_layer < 0 or start_layer >= self.num_layers:
+            raise ValueError(f'Layer index {start_layer} out of range for {self.num_layers} layers')
+        target = (int(self._prefix[start_layer - 1]) if start_layer > 0 else 0) + max_memory
+        end = int(np.searchsorted(self._prefix, target, side='right')) - 1
+        return max(start_layer, min(end, self.num_layers - 1))
+
+    def create_layer_ring(self, num_slots: int, device: str = None) -> LayerRing:
+        device = self.device if device is None else device
+        return LayerRing(num_slots, self.config, device, self.dtype)
+
+    def load_layer_set(self, start_layer: int, end_layer: int, device: str = None, ring: LayerRing = None) -> List[LlamaDecoderLayer]:
         device = self.device if device is None else device
-        return load_layers(start_layer, end_layer, self.layer_prefix, self.layer_files, self.config, self.model_dir, device, self.dtype)
\ No newline at end of file
+        layers = load_layers(start_layer, end_layer, self.layer_prefix, self.layer_files, self.config, self.model_dir, device, self.dtype, self._reader_for(device), ring)
+        if self.compile and ring is None:
+            # dynamic=True keeps one graph as the sequence grows a token per step.
+            layers = [torch.compile(lyr, mode='reduce-overhead', dynamic=True, fullgraph=False) for lyr in layers]
+        return layers
\ No newline at end of file
@@ -1,9 +1,12 @@
+import os
 import gc
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 
-from safetensors import safe_open
 from transformers.models.llama.modeling_llama import LlamaDecoderLayer, LlamaConfig
 
+from llama_layer_collector.helpers import ShardReader
+
 def files_to_load_for_layer(
         layer_prefix: str,
         layer_file_cache: dict,
@@ -29,36 +32,71 @@ def files_to_load_for_layers(
                 files_to_load.append(f)
     return files_to_load
 
+class LayerRing:
+    num_slots: int
+
+    def __init__(self, num_slots: int, config: LlamaConfig, device: str, dtype):
+        # The slot layers are allocated once; reloading a layer copies weights
+        # into an existing slot's parameters instead of hitting the allocator.
+        self.num_slots = num_slots
+        self.slots = [LlamaDecoderLayer(config, i).to(dtype=dtype, device=device) for i in range(num_slots)]
+        self.slot_of: Dict[int, int] = { }
+        self._next = 0
+
+    def load(self, layer_idx: int, layer_data: dict) -> LlamaDecoderLayer:
+        slot = self._next
+        lyr = self.slots[slot]
+        lyr.load_state_dict(layer_data)
+        lyr.self_attn.layer_idx = layer_idx
+        self.slot_of = { k: v for k, v in self.slot_of.items() if v != slot }
+        self.slot_of[layer_idx] = slot
+        self._next = (self._next + 1) % self.num_slots
+        return lyr
+
 def load_layers(
-        start_layer: int, 
-        end_layer: int, 
+        start_layer: int,
+        end_layer: int,
         layer_prefix: str,
         layer_file_cache: Dict[str, str],
         config: LlamaConfig,
         model_dir: str,
         device: str,
-        dtype: str
+        dtype: str,
+        reader: ShardReader = None,
+        ring: LayerRing = None
     ) -> List[LlamaDecoderLayer]:
+    if reader is None:
+        reader = ShardReader(model_dir)
+    num_layers = end_layer - start_layer + 1
+    if ring is not None and num_layers > ring.num_slots:
+        raise ValueError(f'Cannot load {num_layers} layers into a ring of {ring.num_slots} slots')
     prefixes = [f'{layer_prefix}{i}.' for i in range(start_layer, end_layer+1)]
+    files = files_to_load_for_layers(start_layer, end_layer, layer_prefix, layer_file_cache)
+    if len(files) == 0:
+        return []
+
+    def fetch(file_path: str) -> Dict[str, object]:
+        names = [key for key in reader.keys(file_path) if any(key.startswith(prefix) for prefix in prefixes)]
+        return reader.get_tensors(file_path, names, device, dtype)
+
+    # safe_open releases the GIL during the read, so file fetches run in parallel.
     shard_data = { }
-    for file_path in files_to_load_for_layers(start_layer, end_layer, layer_prefix, layer_file_cache):
-        full_path = f'{model_dir}/{file_path}'
-        shard: dict = safe_open(full_path, framework='pt', device=device)
-        for key in shard.keys():
-            for prefix in prefixes:
-                if key.startswith(prefix):
-                    shard_data[key] = shard.get_tensor(key).detach().to(dtype)
-        del shard
-        gc.collect()
-    
+    with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count())) as executor:
+        for result in executor.map(fetch, files):
+            shard_data.update(result)
+    gc.collect()
+
     layers = []
     for i in range(start_layer, end_layer+1):
-        lyr = LlamaDecoderLayer(config, i).to(dtype=dtype)
         layer_data = { }
         for key in shard_data.keys():
             if key.startswith(f'{layer_prefix}{i}.'):
                 layer_data[key.replace(f'{layer_prefix}{i}.', '')] = shard_data[key].detach()
-        lyr.load_state_dict(layer_data)
-        layers.append(lyr)
+        if ring is not None:
+            layers.append(ring.load(i, layer_data))
+        else:
+            lyr = LlamaDecoderLayer(config, i).to(dtype=dtype)
+            lyr.load_state_dict(layer_data)
+            layers.append(lyr)
 
-    return layers
\ No newline at end of file
+    return layers
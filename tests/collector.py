@@ -4,15 +4,15 @@ import json
 import unittest
 
 import torch
-from torch import tensor
 from transformers import AutoTokenizer
+from transformers.cache_utils import DynamicCache
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
 
 from llama_layer_collector.layer_collector import LlamaLayerCollector
 from llama_layer_collector.compute import compute_embedding, compute_head, compute_layer
 from llama_layer_collector.cache import get_shard_files
-from llama_layer_collector.helpers import load_shard_tensor
+from llama_layer_collector.helpers import load_shard_tensor, get_size_of_layer, get_layer_sizes
 from llama_layer_collector.load_layer import files_to_load_for_layer
 
 CACHE_FILE_1B: str = 'data/Llama3.2-1b-instruct-cache.json'
@@ -35,6 +35,10 @@ class LlamaLayerCollectorTests(unittest.TestCase):
             os.remove(CACHE_FILE_1B)
         if os.path.exists(CACHE_FILE_8B):
             os.remove(CACHE_FILE_8B)
+        # Shared across tests so the safetensors headers are only parsed once;
+        # tests that mutate the cache file build their own collector.
+        cls.collector_1b = LlamaLayerCollector(MODEL_DIR_1B, CACHE_FILE_1B)
+        cls.collector_8b = LlamaLayerCollector(MODEL_DIR_8B, CACHE_FILE_8B)
 
     @classmethod
     def tearDownClass(cls):
@@ -44,7 +48,7 @@ class LlamaLayerCollectorTests(unittest.TestCase):
             os.remove(CACHE_FILE_8B)
 
     def test_cache_1B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_1B, CACHE_FILE_1B)
+        collector = self.collector_1b
         self.assertEqual(len(collector.layer_files.keys()), NUM_KEYS_1B)
         self.assertTrue(os.path.exists(CACHE_FILE_1B))
         self.assertTrue(os.path.exists(collector.cache_file))
@@ -53,7 +57,7 @@ class LlamaLayerCollectorTests(unittest.TestCase):
             self.assertEqual(len(cache.keys()), NUM_KEYS_1B)
 
     def test_cache_8B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_8B, CACHE_FILE_8B)
+        collector = self.collector_8b
         self.assertEqual(len(collector.layer_files.keys()), NUM_KEYS_8B)
         self.assertTrue(os.path.exists(CACHE_FILE_8B))
         self.assertTrue(os.path.exists(collector.cache_file))
@@ -62,7 +66,7 @@ class LlamaLayerCollectorTests(unittest.TestCase):
             self.assertEqual(len(cache.keys()), NUM_KEYS_8B)
     
     def test_input_embedding_1B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_1B, CACHE_FILE_1B)
+        collector = self.collector_1b
         input_embedder = collector.load_input_embedding()
         tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR_1B)
         input_ids = tokenizer(PROMPT, return_tensors='pt')['input_ids']
@@ -76,7 +80,7 @@ class LlamaLayerCollectorTests(unittest.TestCase):
     def test_input_embedding_8B(self):
         tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR_8B)
         input_ids = tokenizer(PROMPT, return_tensors='pt')['input_ids']
-        collector = LlamaLayerCollector(MODEL_DIR_8B, CACHE_FILE_8B)
+        collector = self.collector_8b
         input_embedder = collector.load_input_embedding()
         state = compute_embedding(input_embedder, input_ids, collector.config)
         self.assertEqual(state.state.shape, (1, 9, 4096))
@@ -86,57 +90,118 @@ class LlamaLayerCollectorTests(unittest.TestCase):
         self.assertEqual(state.causal_mask.shape, (1, 1, 9, 9))
 
     def test_norm_1B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_1B, CACHE_FILE_1B)
+        collector = self.collector_1b
         norm = collector.load_norm()
         self.assertEqual(norm.weight.shape, (2048,))
     
     def test_norm_8B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_8B, CACHE_FILE_8B)
+        collector = self.collector_8b
         norm = collector.load_norm()
         self.assertEqual(norm.weight.shape, (4096,))
     
     def test_head_1B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_1B, CACHE_FILE_1B)
+        collector = self.collector_1b
         head = collector.load_head()
         self.assertEqual(head.weight.shape, (128256, 2048))
     
     def test_head_8B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_8B, CACHE_FILE_8B)
+        collector = self.collector_8b
         head = collector.load_head()
         self.assertEqual(head.weight.shape, (128256, 4096))
 
     def test_layers_1B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_1B, CACHE_FILE_1B)
+        collector = self.collector_1b
         layers = collector.load_layer_set(1, 2)
         self.assertEqual(len(layers), 2)
 
     def test_layers_8B(self):
-        collector = LlamaLayerCollector(MODEL_DIR_8B, CACHE_FILE_8B)
+        collector = self.collector_8b
         layers = collector.load_layer_set(1, 2)
         self.assertEqual(len(layers), 2)
 
+    def test_layer_sizes_1B(self):
+        collector = self.collector_1b
+        # The analytic formula must match the bytes of the actual shard tensors.
+        expected = 0
+        for name in collector.layer_files:
+            if name.startswith(f'{collector.layer_prefix}0.'):
+                t = load_shard_tensor(collector.layer_files, collector.model_dir, name, 'cpu', collector.dtype)
+                expected += t.numel() * t.element_size()
+        self.assertEqual(get_size_of_layer(0, collector.dtype, collector.config), expected)
+        sizes = get_layer_sizes(collector.dtype, collector.config)
+        self.assertEqual(len(sizes), collector.num_layers)
+        self.assertEqual(list(sizes), [expected] * collector.num_layers)
+        try:
+            get_size_of_layer(collector.num_layers, collector.dtype, collector.config)
+            self.fail("Should have thrown an exception")
+        except ValueError:
+            pass
+
+    def test_layers_to_load_by_memory_1B(self):
+        collector = self.collector_1b
+        sizes = collector.layer_size_cache
+        # A budget of exactly two layers' bytes covers layers [0, 1].
+        self.assertEqual(collector.layers_to_load_by_memory(0, sizes[0] + sizes[1]), 1)
+        self.assertEqual(collector.layers_to_load_by_memory(3, sizes[3]), 3)
+        # Too small a budget still returns the start layer; too large clamps to the end.
+        self.assertEqual(collector.layers_to_load_by_memory(0, 0), 0)
+        self.assertEqual(collector.layers_to_load_by_memory(0, sum(sizes) * 2), collector.num_layers - 1)
+        try:
+            collector.layers_to_load_by_memory(collector.num_layers, sizes[0])
+            self.fail("Should have thrown an exception")
+        except ValueError:
+            pass
+
+    def test_layer_ring_1B(self):
+        collector = self.collector_1b
+        ring = collector.create_layer_ring(2)
+        layers = collector.load_layer_set(0, 1, ring=ring)
+        self.assertEqual(len(layers), 2)
+        self.assertIs(layers[0], ring.slots[0])
+        self.assertIs(layers[1], ring.slots[1])
+        self.assertEqual(ring.slot_of, {0: 0, 1: 1})
+        # Reloading a later chunk reuses the same slot modules in place.
+        layers = collector.load_layer_set(2, 3, ring=ring)
+        self.assertIs(layers[0], ring.slots[0])
+        self.assertEqual(layers[0].self_attn.layer_idx, 2)
+        self.assertEqual(ring.slot_of, {2: 0, 3: 1})
+        fresh = collector.load_layer_set(2, 2)[0]
+        self.assertTrue(torch.equal(layers[0].self_attn.q_proj.weight, fresh.self_attn.q_proj.weight))
+        try:
+            collector.load_layer_set(0, 2, ring=ring)
+            self.fail("Should have thrown an exception")
+        except ValueError:
+            pass
+
     def test_stack_1B(self):
         tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR_1B)
         input_ids = tokenizer(PROMPT, return_tensors='pt')['input_ids']
         original_num_tokens = input_ids.shape[1]
         num_tokens = 4
         current_token = 0
-        collector = LlamaLayerCollector(MODEL_DIR_1B, CACHE_FILE_1B)
+        collector = self.collector_1b
         input_embedder = collector.load_input_embedding()
         head = collector.load_head()
         norm = collector.load_norm()
         layers = collector.load_layer_set(0, 15)
-        while current_token < num_tokens:
-            state = compute_embedding(input_embedder, input_ids, collector.config)
-            for lyr in layers:
-                state.state = compute_layer(lyr, state)
-            topk = 1
-            result = compute_head(head, norm(state.state), topk)
-            self.assertEqual(result.shape, (1, topk))
-            token_list = input_ids.tolist()[0]
-            token_list.append(result[0][0].item())
-            input_ids = tensor([token_list])
-            current_token += 1
+        # Pre-allocate the token buffer once instead of rebuilding a list and
+        # tensor every step.
+        buffer = torch.empty(1, original_num_tokens + num_tokens, dtype=torch.long)
+        buffer[:, :original_num_tokens] = input_ids
+        # The KV-cache means each step past the first only processes the new token.
+        past_key_values = DynamicCache()
+        with torch.inference_mode():
+            while current_token < num_tokens:
+                input_ids = buffer[:, :original_num_tokens + current_token]
+                state = compute_embedding(input_embedder, input_ids, collector.config, past_key_values)
+                for lyr in layers:
+                    state.state = compute_layer(lyr, state)
+                topk = 1
+                result = compute_head(head, norm(state.state), topk)
+                self.assertEqual(result.shape, (1, topk))
+                buffer[0, original_num_tokens + current_token] = result[0][0]
+                current_token += 1
+        input_ids = buffer
         print(tokenizer.decode(input_ids[0]))
         self.assertGreater(input_ids.shape[1], original_num_tokens)
 
@@ -146,7 +211,8 @@ class LlamaLayerCollectorTests(unittest.TestCase):
         original_num_tokens = input_ids.shape[1]
         num_tokens = 4
         current_token = 0
-        os.remove(CACHE_FILE_1B)
+        if os.path.exists(CACHE_FILE_1B):
+            os.remove(CACHE_FILE_1B)
         collector = LlamaLayerCollector(MODEL_DIR_1B)
         self.assertFalse(os.path.exists(CACHE_FILE_1B))
         self.assertTrue(collector.layer_files is not None)
@@ -154,17 +220,20 @@ class LlamaLayerCollectorTests(unittest.TestCase):
         head = collector.load_head()
         norm = collector.load_norm()
         layers = collector.load_layer_set(0, 15)
-        while current_token < num_tokens:
-            state = compute_embedding(input_embedder, input_ids, collector.config)
-            for lyr in layers:
-                state.state = compute_layer(lyr, state)
-            topk = 1
-            result = compute_head(head, norm(state.state), topk)
-            self.assertEqual(result.shape, (1, topk))
-            token_list = input_ids.tolist()[0]
-            token_list.append(result[0][0].item())
-            input_ids = tensor([token_list])
-            current_token += 1
+        buffer = torch.empty(1, original_num_tokens + num_tokens, dtype=torch.long)
+        buffer[:, :original_num_tokens] = input_ids
+        with torch.inference_mode():
+            while current_token < num_tokens:
+                input_ids = buffer[:, :original_num_tokens + current_token]
+                state = compute_embedding(input_embedder, input_ids, collector.config)
+                for lyr in layers:
+                    state.state = compute_layer(lyr, state)
+                topk = 1
+                result = compute_head(head, norm(state.state), topk)
+                self.assertEqual(result.shape, (1, topk))
+                buffer[0, original_num_tokens + current_token] = result[0][0]
+                current_token += 1
+        input_ids = buffer
         print(tokenizer.decode(input_ids[0]))
         self.assertGreater(input_ids.shape[1], original_num_tokens)
 